@@ -6,33 +6,49 @@ import enum
 import shutil
 import sys
 
-from fuzzywuzzy import fuzz
+import numpy as np
 from openpyxl import load_workbook
 from openpyxl.styles import PatternFill
 from openpyxl.utils import column_index_from_string
 from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet.worksheet import Worksheet
+from rapidfuzz import fuzz, process, utils
 
 COLOR_LITERAL_MATCH = "90EE90"
 COLOR_FUZZY_HIGH_SCORE = "FCE883"
 COLOR_FUZZY_LOW_SCORE = "FF91A4"
 
+# progress is reported once every PROGRESS_INTERVAL rows
+PROGRESS_INTERVAL = 128
+
+# number of destination strings scored against the source per cdist call
+SCORE_BATCH_SIZE = 4096
+
+FILL_LITERAL = PatternFill(fill_type="solid", start_color=COLOR_LITERAL_MATCH)
+FILL_FUZZY_HI = PatternFill(fill_type="solid",
+                            start_color=COLOR_FUZZY_HIGH_SCORE)
+FILL_FUZZY_LO = PatternFill(fill_type="solid",
+                            start_color=COLOR_FUZZY_LOW_SCORE)
+
+# marks destination rows without a literal match in the source
+NO_MATCH = object()
+
 
 class MessageType(enum.Enum):
-    GENERAL = 0,
-    INFO = 1,
+    GENERAL = 0
+    INFO = 1
     ERROR = 2
 
 
+MESSAGE_PREFIXES = {
+    MessageType.GENERAL: "[*] ",
+    MessageType.INFO: "[i] ",
+    MessageType.ERROR: "[!] "
+}
+
+
 def fancy_message(message: str, type: MessageType) -> str:
-    prefix = ""
-    if type == MessageType.INFO:
-        prefix = "[i] "
-    if type == MessageType.ERROR:
-        prefix = "[!] "
-    if type == MessageType.GENERAL:
-        prefix = "[*] "
-    return prefix + message
+    return MESSAGE_PREFIXES.get(type, "") + message
 
 
 def new_file_name(fname: str, suffix: str) -> str:
@@ -42,69 +58,128 @@ def new_file_name(fname: str, suffix: str) -> str:
     return fname[:last_dot] + "_" + suffix + fname[last_dot:]
 
 
-def find_match(string_to_match: str, d: dict, w: bool) -> tuple:
-    max_score = 0
-    matched_string = ""
-    for potential_match in d.keys():
-        score = fuzz.WRatio(string_to_match,
-                            potential_match) if w else fuzz.QRatio(
-                                string_to_match, potential_match)
-        if score >= max_score:
-            max_score = score
-            matched_string = potential_match
-    return (matched_string, max_score)
+def normalize_value(v) -> str:
+    # empty cells become empty strings rather than "None"
+    if isinstance(v, str):
+        return v.strip()
+    return "" if v is None else str(v).strip()
 
 
 def build_source_dict(sheet: Worksheet, match_column: str, source_column: str,
-                      min_row: int, max_row: int) -> dict:
-    source_dict = {}
-    row_count = min_row
+                      min_row: int, max_row: int) -> tuple:
     match_index = column_index_from_string(match_column) - 1
     source_index = column_index_from_string(source_column) - 1
-    for row in sheet.iter_rows(min_row=min_row, max_row=max_row):
-        sys.stdout.write(
-            fancy_message(f"Source document: reading row {row_count}\r",
-                          MessageType.GENERAL))
-        sys.stdout.flush()
-        key = str(row[match_index].value).strip()
-        value = row[source_index].value
-        source_dict[key] = value
-        row_count += 1
-    return source_dict
+    first_index = min(match_index, source_index)
+    key_offset = match_index - first_index
+    value_offset = source_index - first_index
+    rows = sheet.iter_rows(min_row=min_row,
+                           max_row=max_row,
+                           min_col=first_index + 1,
+                           max_col=max(match_index, source_index) + 1,
+                           values_only=True)
+    # rows with an empty match cell can't be matched, so they are left out
+    source_dict = {
+        normalize_value(row[key_offset]): row[value_offset]
+        for row in rows if row[key_offset] is not None
+    }
+    # same data keyed by lowercase strings, used as a fast pre-filter before fuzzy matching
+    norm_source_dict = {k.lower(): v for k, v in source_dict.items()}
+    return (source_dict, norm_source_dict)
 
 
 def update_dest(sheet: Worksheet, match_column: str, dest_column: str,
-                min_row: int, max_row: int, source: dict, score_threshold: int,
-                weighted: bool):
-    for i in range(min_row, max_row + 1):
-        sys.stdout.write(
-            fancy_message(f"Destination document: updating row {i}\r",
-                          MessageType.GENERAL))
-        sys.stdout.flush()
-        cell_match = match_column + str(i)
-        cell_dest = dest_column + str(i)
-        string_to_match = str(sheet[cell_match].value).strip()
-
-        # try literal match at first
-        if string_to_match != "" and string_to_match in source.keys():
-            # only update cells that do not match the source already
-            if sheet[cell_dest].value != source[string_to_match]:
-                sheet[cell_dest] = source[string_to_match]
-                color_fill = PatternFill(fill_type="solid",
-                                         start_color=COLOR_LITERAL_MATCH)
-                sheet[cell_dest].fill = color_fill
-        else:  # now try fuzzy matching
-            matched_string, score = find_match(string_to_match, source,
-                                               weighted)
-            if score >= score_threshold:
-                # only update cells that do not match the source already
-                if sheet[cell_dest].value != source[matched_string]:
-                    sheet[cell_dest] = source[matched_string]
-                    # if ratio is 99 or 100, set the background color to yellow, otherwise set it to red
-                    fill_color = COLOR_FUZZY_LOW_SCORE if score < 99 else COLOR_FUZZY_HIGH_SCORE
-                    color_fill = PatternFill(fill_type="solid",
-                                             start_color=fill_color)
-                    sheet[cell_dest].fill = color_fill
+                min_row: int, max_row: int, source: dict, norm_source: dict,
+                score_threshold: int, weighted: bool, workers: int):
+    if not source:
+        return
+
+    # read all the strings to match along with the current destination values
+    match_index = column_index_from_string(match_column) - 1
+    dest_index = column_index_from_string(dest_column) - 1
+    first_index = min(match_index, dest_index)
+    rows = list(
+        sheet.iter_rows(min_row=min_row,
+                        max_row=max_row,
+                        min_col=first_index + 1,
+                        max_col=max(match_index, dest_index) + 1,
+                        values_only=True))
+    queries = [
+        normalize_value(row[match_index - first_index]) for row in rows
+    ]
+    dest_values = [row[dest_index - first_index] for row in rows]
+    dest_col = dest_index + 1
+
+    # try literal match at first
+    literal_hits = [
+        source.get(q, NO_MATCH) if q != "" else NO_MATCH for q in queries
+    ]
+
+    # then try matching regardless of case; such a match would score 100, so
+    # this is only a shortcut for fuzzy matching and obeys the same threshold
+    norm_hits = [
+        norm_source.get(q.lower(), NO_MATCH)
+        if q != "" and hit is NO_MATCH and score_threshold <= 100 else NO_MATCH
+        for q, hit in zip(queries, literal_hits)
+    ]
+
+    # now try fuzzy matching, scoring the distinct misses in batches to bound
+    # the size of the score matrix; default_process mirrors the preprocessing
+    # fuzzywuzzy used to do.
+    # Scores are within 0-100, so a higher threshold never matches anything
+    # and a negative one works the same as 0; empty cells are never matched
+    score_threshold = max(score_threshold, 0)
+    misses = list(
+        dict.fromkeys(
+            q for q, hit, norm_hit in zip(queries, literal_hits, norm_hits)
+            if q != "" and hit is NO_MATCH and norm_hit is NO_MATCH))
+    fuzzy_hits = {}
+    if misses and score_threshold <= 100:
+        choices = list(source)
+        # QRatio is a single bit-parallel InDel comparison; WRatio adds several
+        # partial and token-based passes per pair, so it is only used on request
+        scorer = fuzz.WRatio if weighted else fuzz.QRatio
+        for start in range(0, len(misses), SCORE_BATCH_SIZE):
+            batch = misses[start:start + SCORE_BATCH_SIZE]
+            # scores are 0-100, so a uint8 matrix is enough; the cutoff is
+            # applied to the unrounded score, so it is lowered by 0.5 to keep
+            # scores that round up to the threshold, as fuzzywuzzy did
+            scores = process.cdist(batch,
+                                   choices,
+                                   scorer=scorer,
+                                   processor=utils.default_process,
+                                   score_cutoff=max(0, score_threshold - 0.5),
+                                   workers=workers,
+                                   dtype=np.uint8)
+            # on ties the last source key wins, so search the reversed columns
+            best = len(choices) - 1 - scores[:, ::-1].argmax(axis=1)
+            best_scores = scores[np.arange(len(batch)), best]
+            # only the queries that reached the threshold are looked at again
+            for n in np.flatnonzero(best_scores >= score_threshold):
+                fuzzy_hits[batch[n]] = (source[choices[best[n]]],
+                                        best_scores[n])
+
+    # write the matches to the destination column
+    for n, hit in enumerate(literal_hits):
+        i = min_row + n
+        if i % PROGRESS_INTERVAL == 0:
+            sys.stdout.write(
+                fancy_message(f"Destination document: updating row {i}\r",
+                              MessageType.GENERAL))
+            sys.stdout.flush()
+        if hit is not NO_MATCH:
+            value, color_fill = hit, FILL_LITERAL
+        elif norm_hits[n] is not NO_MATCH:
+            # a case-only difference would score 100 anyway
+            value, color_fill = norm_hits[n], FILL_FUZZY_HI
+        elif queries[n] in fuzzy_hits:
+            value, score = fuzzy_hits[queries[n]]
+            # if ratio is 99 or 100, set the background color to yellow, otherwise set it to red
+            color_fill = FILL_FUZZY_LO if score < 99 else FILL_FUZZY_HI
+        else:
+            continue
+        # only update cells that do not match the source already
+        if dest_values[n] != value:
+            sheet.cell(row=i, column=dest_col, value=value).fill = color_fill
 
 
 def get_workbook(path: str, ro: bool) -> Workbook:
@@ -219,8 +294,18 @@ def get_args() -> argparse.Namespace:
         "-w",
         "--weighted",
         help=
-        "use weighted ratio instead of simple ratio for calculating scores",
+        "use weighted ratio instead of simple ratio for calculating scores (slower, but more tolerant of reordered or partial words)",
         action='store_true')
+    argparser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        nargs="?",
+        const=-1,
+        default=-1,
+        help=
+        "number of threads used to calculate scores, -1 means all CPU cores (default: -1)"
+    )
     return argparser.parse_args()
 
 
@@ -255,17 +340,18 @@ def parse_arguments(args: argparse.Namespace) -> tuple:
     threshold = args.threshold
     no_backup = args.no_backup
     weighted = args.weighted
+    jobs = args.jobs
 
     return (dest_file_name, source_file_name, output_file_name,
             dest_match_column, dest_column, source_match_column, source_column,
             dest_min_row, dest_max_row, source_min_row, source_max_row,
-            threshold, no_backup, weighted)
+            threshold, no_backup, weighted, jobs)
 
 
 def main():
     #get the command line arguments and parse them
     args = get_args()
-    dest_file_name, source_file_name, output_file_name, dest_match_column, dest_column, source_match_column, source_column, dest_min_row, dest_max_row, source_min_row, source_max_row, threshold, no_backup, weighted = parse_arguments(
+    dest_file_name, source_file_name, output_file_name, dest_match_column, dest_column, source_match_column, source_column, dest_min_row, dest_max_row, source_min_row, source_max_row, threshold, no_backup, weighted, jobs = parse_arguments(
         args)
 
     # if the output file is the same as the destination file and the --no-backup flag is not set, create a backup copy of the destination file
@@ -300,16 +386,17 @@ def main():
             MessageType.INFO))
 
     # this dictionary holds the data from the source file
-    source_dict = build_source_dict(source_sheet, source_match_column,
-                                    source_column, source_min_row,
-                                    source_max_row)
+    source_dict, norm_source_dict = build_source_dict(
+        source_sheet, source_match_column, source_column, source_min_row,
+        source_max_row)
     print(
         fancy_message("Source document: all rows read successfully",
                       MessageType.INFO))
 
     # update the destination worksheet
     update_dest(dest_sheet, dest_match_column, dest_column, dest_min_row,
-                dest_max_row, source_dict, threshold, weighted)
+                dest_max_row, source_dict, norm_source_dict, threshold,
+                weighted, jobs)
     print(
         fancy_message("Destination document: all rows updated successfully",
                       MessageType.INFO))
@@ -13,30 +13,32 @@ from openpyxl.utils import column_index_from_string
 from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet.worksheet import Worksheet
 
+# progress is reported once every PROGRESS_INTERVAL rows
+PROGRESS_INTERVAL = 128
+
+# six hex digits, e.g. FFFF00
+COLOR_REGEX = re.compile('[0-9a-fA-F]{6}')
+
 
 class MessageType(enum.Enum):
-    GENERAL = 0,
-    INFO = 1,
+    GENERAL = 0
+    INFO = 1
     ERROR = 2
 
 
+MESSAGE_PREFIXES = {
+    MessageType.GENERAL: "[*] ",
+    MessageType.INFO: "[i] ",
+    MessageType.ERROR: "[!] "
+}
+
+
 def is_valid_color(rgb: str) -> bool:
-    p = re.compile('^[0-9a-fA-F]{6}$')
-    if p.match(rgb):
-        return True
-    else:
-        return False
+    return COLOR_REGEX.fullmatch(rgb) is not None
 
 
 def fancy_message(message: str, type: MessageType) -> str:
-    prefix = ""
-    if type == MessageType.INFO:
-        prefix = "[i] "
-    if type == MessageType.ERROR:
-        prefix = "[!] "
-    if type == MessageType.GENERAL:
-        prefix = "[*] "
-    return prefix + message
+    return MESSAGE_PREFIXES.get(type, "") + message
 
 
 def new_file_name(fname: str, suffix: str) -> str:
@@ -50,26 +52,106 @@ def sanitize_string(s: str) -> str:
     return s.strip().lower()
 
 
+def value_to_string(v) -> str:
+    # empty cells become empty strings rather than "None"
+    if isinstance(v, str):
+        return v
+    return "" if v is None else str(v)
+
+
 def build_source_dict(source_sheet: Worksheet, source_match_column: str,
                       source_column: str, source_min_row: int,
                       source_max_row: int, ignore_case: bool) -> dict:
-    source_dict = {}
-    row_count = source_min_row
     match_index = column_index_from_string(source_match_column) - 1
     source_index = column_index_from_string(source_column) - 1
-    for row in source_sheet.iter_rows(min_row=source_min_row,
-                                      max_row=source_max_row):
-        sys.stdout.write(
-            fancy_message(f"Source document: reading row {row_count}\r",
-                          MessageType.GENERAL))
-        sys.stdout.flush()
-        key = sanitize_string(str(
-            row[match_index].value)) if ignore_case else str(
-                row[match_index].value)
-        value = row[source_index].value
-        source_dict[key] = value
-        row_count += 1
-    return source_dict
+    first_index = min(match_index, source_index)
+    last_index = max(match_index, source_index)
+    key_offset = match_index - first_index
+    value_offset = source_index - first_index
+    rows = source_sheet.iter_rows(min_row=source_min_row,
+                                  max_row=source_max_row,
+                                  min_col=first_index + 1,
+                                  max_col=last_index + 1,
+                                  values_only=True)
+    # rows with an empty match cell can't be matched, so they are left out
+    if ignore_case:
+        return {
+            sanitize_string(value_to_string(row[key_offset])): row[value_offset]
+            for row in rows if row[key_offset] is not None
+        }
+    return {
+        value_to_string(row[key_offset]): row[value_offset]
+        for row in rows if row[key_offset] is not None
+    }
+
+
+def update_dest(dest_sheet: Worksheet, dest_match_column: str,
+                dest_column: str, dest_min_row: int, dest_max_row: int,
+                source_dict: dict, ignore_case: bool, bg_color: str):
+    # the same fill is shared by all the highlighted cells
+    color_fill = PatternFill(fill_type="solid",
+                             start_color=bg_color) if bg_color != "None" else None
+    dest_match_index = column_index_from_string(dest_match_column) - 1
+    dest_index = column_index_from_string(dest_column) - 1
+    first_index = min(dest_match_index, dest_index)
+    dest_rows = list(
+        dest_sheet.iter_rows(min_row=dest_min_row,
+                             max_row=dest_max_row,
+                             min_col=first_index + 1,
+                             max_col=max(dest_match_index, dest_index) + 1,
+                             values_only=True))
+    match_values = [row[dest_match_index - first_index] for row in dest_rows]
+    dest_values = [row[dest_index - first_index] for row in dest_rows]
+    dest_col = dest_index + 1
+    if ignore_case:
+        keys = [sanitize_string(value_to_string(v)) for v in match_values]
+    else:
+        keys = [value_to_string(v) for v in match_values]
+    for i, (key, dest_value) in enumerate(zip(keys, dest_values),
+                                          start=dest_min_row):
+        if i % PROGRESS_INTERVAL == 0:
+            sys.stdout.write(
+                fancy_message(f"Destination document: updating row {i}\r",
+                              MessageType.GENERAL))
+            sys.stdout.flush()
+        if key != "" and key in source_dict:
+            # only update the cells that do not match the source
+            if dest_value != source_dict[key]:
+                cell = dest_sheet.cell(row=i,
+                                       column=dest_col,
+                                       value=source_dict[key])
+                if color_fill is not None:
+                    cell.fill = color_fill
+
+
+def stream_dest(dest_sheet, out_sheet, dest_match_column: str,
+                dest_column: str, dest_min_row: int, dest_max_row: int,
+                source_dict: dict, ignore_case: bool):
+    # dest_sheet is the read-only active sheet of the destination document,
+    # out_sheet is a sheet of a write-only workbook; neither is a Worksheet
+    dest_match_index = column_index_from_string(dest_match_column) - 1
+    dest_index = column_index_from_string(dest_column) - 1
+    dest_rows = dest_sheet.iter_rows(min_row=1, values_only=True)
+    for i, row in enumerate(dest_rows, start=1):
+        row = list(row)
+        # rows outside of the requested range are copied as they are; the max
+        # row of a read-only sheet is None if the file does not record it
+        if i >= dest_min_row and (dest_max_row is None or i <= dest_max_row):
+            if i % PROGRESS_INTERVAL == 0:
+                sys.stdout.write(
+                    fancy_message(f"Destination document: updating row {i}\r",
+                                  MessageType.GENERAL))
+                sys.stdout.flush()
+            match_value = row[dest_match_index] if dest_match_index < len(
+                row) else None
+            key = value_to_string(match_value)
+            if ignore_case:
+                key = sanitize_string(key)
+            if key != "" and key in source_dict:
+                if dest_index >= len(row):
+                    row.extend([None] * (dest_index + 1 - len(row)))
+                row[dest_index] = source_dict[key]
+        out_sheet.append(row)
 
 
 def get_workbook(path: str, ro: bool) -> Workbook:
@@ -186,6 +268,12 @@ def get_args() -> argparse.Namespace:
         help=
         "set the background color of changed cells to the specified color (default: FFFF00)"
     )
+    argparser.add_argument(
+        "-s",
+        "--stream",
+        help=
+        "stream the destination document instead of loading it into memory (faster, but only the cell values of the active worksheet are kept; ignored with -c)",
+        action='store_true')
     return argparser.parse_args()
 
 
@@ -228,27 +316,49 @@ def parse_arguments(args: argparse.Namespace) -> tuple:
     # other settings
     ignore_case = args.ignore_case
     no_backup = args.no_backup
+    stream = args.stream
 
     return (dest_file_name, source_file_name, output_file_name,
             dest_match_column, dest_column, source_match_column, source_column,
             dest_min_row, dest_max_row, source_min_row, source_max_row,
-            ignore_case, no_backup, bg_color)
+            ignore_case, no_backup, bg_color, stream)
 
 
 def main():
 
     #get the command line arguments and parse them
     args = get_args()
-    dest_file_name, source_file_name, output_file_name, dest_match_column, dest_column, source_match_column, source_column, dest_min_row, dest_max_row, source_min_row, source_max_row, ignore_case, no_backup, bg_color = parse_arguments(
+    dest_file_name, source_file_name, output_file_name, dest_match_column, dest_column, source_match_column, source_column, dest_min_row, dest_max_row, source_min_row, source_max_row, ignore_case, no_backup, bg_color, stream = parse_arguments(
         args)
 
+    # highlighting needs the styles of the destination document, so it can't be streamed
+    if stream and bg_color != "None":
+        print(
+            fancy_message(
+                "Streaming is not possible when highlighting changed cells, loading the whole document.",
+                MessageType.INFO))
+        stream = False
+
+    # streaming drops formatting and other worksheets, so never overwrite the destination without a backup
+    if stream and output_file_name == dest_file_name and no_backup:
+        print(
+            fancy_message(
+                "Streaming would overwrite the destination document without a backup, use -o or drop -n.",
+                MessageType.ERROR))
+        sys.exit(2)
+    if stream:
+        print(
+            fancy_message(
+                "Streaming requested, only the cell values of the active worksheet will be kept.",
+                MessageType.INFO))
+
     # if the output file is the same as the destination file and the --no-backup flag is not set, create a backup copy of the destination file
     if output_file_name == dest_file_name and not no_backup:
         backup_name = new_file_name(dest_file_name, "old")
         shutil.copyfile(dest_file_name, backup_name)
 
     # open the files and get active worksheets
-    dest = get_workbook(dest_file_name, False)
+    dest = get_workbook(dest_file_name, stream)
     source = get_workbook(source_file_name, True)
     dest_sheet = dest.active
     source_sheet = source.active
@@ -268,9 +378,11 @@ def main():
             MessageType.INFO))
     if dest_max_row == -1:
         dest_max_row = dest_sheet.max_row
+    # a read-only sheet has no max row if the file does not record its size
+    last_row = dest_max_row if dest_max_row is not None else "the last row"
     print(
         fancy_message(
-            f"Destination document: using rows {dest_min_row} to {dest_max_row}",
+            f"Destination document: using rows {dest_min_row} to {last_row}",
             MessageType.INFO))
 
     # this dictionary holds the data from the source file
@@ -278,45 +390,21 @@ def main():
                                     source_column, source_min_row,
                                     source_max_row, ignore_case)
 
-    #build the source dictionary
-    row_count = source_min_row
-    match_index = column_index_from_string(source_match_column) - 1
-    source_index = column_index_from_string(source_column) - 1
-    for row in source_sheet.iter_rows(min_row=source_min_row,
-                                      max_row=source_max_row):
-        sys.stdout.write(
-            fancy_message(f"Source document: reading row {row_count}\r",
-                          MessageType.GENERAL))
-        sys.stdout.flush()
-        key = sanitize_string(str(
-            row[match_index].value)) if ignore_case else str(
-                row[match_index].value)
-        value = row[source_index].value
-        source_dict[key] = value
-        row_count += 1
-
     print(
         fancy_message("Source document: all rows processed successfully",
                       MessageType.INFO))
 
-    for i in range(dest_min_row, dest_max_row + 1):
-        sys.stdout.write(
-            fancy_message(f"Destination document: updating row {i}\r",
-                          MessageType.GENERAL))
-        sys.stdout.flush()
-        cell_match = dest_match_column + str(i)
-        cell_dest = dest_column + str(i)
-        key = sanitize_string(str(
-            dest_sheet[cell_match].value)) if ignore_case else str(
-                dest_sheet[cell_match].value)
-        if key != "" and key in source_dict.keys():
-            # only update the cells that do not match the source
-            if dest_sheet[cell_dest].value != source_dict[key]:
-                dest_sheet[cell_dest] = source_dict[key]
-                if bg_color != "None":
-                    color_fill = PatternFill(fill_type="solid",
-                                             start_color=bg_color)
-                    dest_sheet[cell_dest].fill = color_fill
+    if stream:
+        # write the values into a new workbook row by row as they are read
+        out = Workbook(write_only=True)
+        stream_dest(dest_sheet, out.create_sheet(dest_sheet.title),
+                    dest_match_column, dest_column, dest_min_row,
+                    dest_max_row, source_dict, ignore_case)
+        dest.close()
+        dest = out
+    else:
+        update_dest(dest_sheet, dest_match_column, dest_column, dest_min_row,
+                    dest_max_row, source_dict, ignore_case, bg_color)
 
     print(
         fancy_message("Destination document: all rows updated successfully",